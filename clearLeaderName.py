@@ -1,14 +1,39 @@
 import sqlite3
-def clear_leaderboard():
+from datetime import datetime
+
+# به جای پاک کردن کامل جدول، فصل جاری بسته و در season_totals بایگانی می‌شود و فصل جدید شروع می‌شود
+def close_season():
     db_path = "plugins/questions.db"
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
         with sqlite3.connect(db_path) as conn:
             cursor = conn.cursor()
+            row = cursor.execute(
+                "SELECT season_id FROM seasons WHERE closed_at IS NULL ORDER BY season_id DESC LIMIT 1").fetchone()
+            season_id = row[0] if row else cursor.execute(
+                "INSERT INTO seasons (started_at) VALUES (?)", (now,)).lastrowid
+            cursor.execute(
+                """
+                INSERT INTO season_totals (season_id, user_id, username, correct_answers)
+                SELECT ?, user_id, username, total_correct
+                FROM (
+                    SELECT user_id, username,
+                           SUM(correct_answers) OVER (PARTITION BY user_id) AS total_correct,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY game_date DESC) AS rn
+                    FROM leaderboard
+                )
+                WHERE rn = 1
+                ON CONFLICT(season_id, user_id) DO UPDATE SET
+                    correct_answers = correct_answers + excluded.correct_answers,
+                    username = excluded.username
+                """, (season_id,))
             cursor.execute("DELETE FROM leaderboard")
+            cursor.execute("DELETE FROM user_totals")
+            cursor.execute("UPDATE seasons SET closed_at = ? WHERE season_id = ?", (now, season_id))
+            cursor.execute("INSERT INTO seasons (started_at) VALUES (?)", (now,))
             conn.commit()
-            # logger.info("Leaderboard cleared successfully.")
+            print(f"فصل {season_id} بسته و بایگانی شد")
     except Exception as e:
-        pass
-        # logger.error(f"Error clearing leaderboard: {str(e)}")
+        print(f"خطا در بستن فصل: {str(e)}")
 
-clear_leaderboard()
\ No newline at end of file
+close_season()
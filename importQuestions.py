@@ -0,0 +1,133 @@
+import hashlib
+import sqlite3
+import sys
+import openpyxl
+
+DB_PATH = "plugins/questions.db"
+BATCH_SIZE = 500
+
+# هر فایل اکسل به جدول متناظرش در TOPIC_TO_TABLE نوشته می‌شود
+WORKBOOK_TO_TABLE = {
+    "plugins/calan.xlsx": "questions_calan",
+    "plugins/tose.xlsx": "questions_development",
+    "plugins/tg.xlsx": "questions_international_trade",
+    "plugins/kh.xlsx": "questions_microeconomics",
+    "اقتصاد خرد.xlsx": "questions_microeconomics",
+}
+
+def clean(value):
+    return str(value).replace("\\n", "\n").strip() if value is not None else ""
+
+def content_hash(question, correct, wrong):
+    return hashlib.sha1("\x1f".join((clean(question), clean(correct), clean(wrong))).encode("utf-8")).hexdigest()
+
+def find_columns(header):
+    columns = {}
+    for idx, title in enumerate(header):
+        title = clean(title)
+        if not title:
+            continue
+        if "سوال" in title:
+            columns.setdefault("question", idx)
+        elif "غلط" in title or "غلظ" in title:
+            columns.setdefault("wrong", idx)
+        elif "صحیح" in title or "درست" in title:
+            columns.setdefault("correct", idx)
+    missing = {"question", "correct", "wrong"} - columns.keys()
+    if missing:
+        raise ValueError(f"ستون‌های {', '.join(sorted(missing))} در سطر عنوان پیدا نشد")
+    return columns["question"], columns["correct"], columns["wrong"]
+
+def prepare_table(conn, table_name):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+    if not columns:
+        conn.execute(f"""
+            CREATE TABLE {table_name} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT NOT NULL,
+                option1 TEXT NOT NULL,
+                option2 TEXT NOT NULL,
+                correct_answer TEXT NOT NULL,
+                content_hash TEXT
+            )
+        """)
+    elif "content_hash" not in columns:
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN content_hash TEXT")
+    # سطرهایی که دستی وارد شده‌اند هش ندارند؛ یک بار هش آن‌ها محاسبه می‌شود
+    seen = {row[0] for row in conn.execute(f"SELECT content_hash FROM {table_name} WHERE content_hash IS NOT NULL")}
+    updates = []
+    for row_id, question, option1, option2, correct_answer in conn.execute(
+            f"SELECT id, question, option1, option2, correct_answer FROM {table_name} WHERE content_hash IS NULL"):
+        if correct_answer == "Option2":
+            option1, option2 = option2, option1
+        digest = content_hash(question, option1, option2)
+        if digest not in seen:
+            seen.add(digest)
+            updates.append((digest, row_id))
+    conn.executemany(f"UPDATE {table_name} SET content_hash = ? WHERE id = ?", updates)
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table_name}_content_hash ON {table_name}(content_hash)")
+    conn.commit()
+
+def iter_questions(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        question_col, correct_col, wrong_col = find_columns(next(rows, ()))
+        width = max(question_col, correct_col, wrong_col)
+        for row in rows:
+            if len(row) <= width:
+                continue
+            question, correct, wrong = clean(row[question_col]), clean(row[correct_col]), clean(row[wrong_col])
+            if question and correct and wrong:
+                yield question, correct, wrong
+    finally:
+        workbook.close()
+
+def import_workbook(conn, path, table_name):
+    prepare_table(conn, table_name)
+    sql = f"""
+        INSERT INTO {table_name} (question, option1, option2, correct_answer, content_hash)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(content_hash) DO NOTHING
+    """
+    total = inserted = 0
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        before = conn.total_changes
+        with conn:
+            conn.executemany(sql, batch)
+        inserted += conn.total_changes - before
+        batch.clear()
+
+    for question, correct, wrong in iter_questions(path):
+        digest = content_hash(question, correct, wrong)
+        # جای گزینه درست از روی هش تعیین می‌شود تا ورود دوباره همان ترتیب را بدهد
+        if int(digest[-1], 16) & 1:
+            batch.append((question, wrong, correct, "Option2", digest))
+        else:
+            batch.append((question, correct, wrong, "Option1", digest))
+        total += 1
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return total, inserted
+
+def import_questions(paths=None):
+    paths = paths or list(WORKBOOK_TO_TABLE)
+    with sqlite3.connect(DB_PATH) as conn:
+        for path in paths:
+            table_name = WORKBOOK_TO_TABLE.get(path)
+            if not table_name:
+                print(f"جدولی برای فایل {path} تعریف نشده است")
+                continue
+            try:
+                total, inserted = import_workbook(conn, path, table_name)
+                print(f"{path} -> {table_name}: {total} سطر خوانده شد، {inserted} سوال جدید اضافه شد")
+            except Exception as e:
+                print(f"خطا در وارد کردن {path}: {str(e)}")
+
+if __name__ == "__main__":
+    import_questions(sys.argv[1:])
@@ -1,15 +1,23 @@
 import asyncio
 import uuid
+import hashlib
 from datetime import datetime, timedelta
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, CallbackQuery
 import sqlite3
 import random
+from array import array
+from functools import lru_cache
+from bisect import bisect_left, insort
 import os
 import logging
 from pyrogram.enums import ChatMemberStatus
-from pyrogram.errors import FloodWait, QueryIdInvalid, MessageNotModified
+from collections import OrderedDict, deque
+from pyrogram.errors import FloodWait, QueryIdInvalid, MessageNotModified, BadRequest, UserNotParticipant
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 sys.stdout.reconfigure(encoding='utf-8')
 
@@ -27,11 +35,52 @@ bot_id = None
 last_access_check = None
 api_request_counter = 0
 failed_request_counter = 0
-processed_queries = set()
 user_cache = {}
 channel_members_cache = {}
+channel_members_diff = {"joined": set(), "left": set()}
 channel_members_lock = asyncio.Lock()
+membership_negative_cache = {}
+membership_lookups = {}
+membership_lookup_failures = {}
+membership_flood = {"until": 0.0}
+channel_members_pending = {}
+background_jobs = {}
+callback_answer_tasks = set()
+lobby_edits = {}
+game_tasks = {}
 answer_queue = asyncio.Queue()
+leaderboard_changed = asyncio.Event()
+
+current_season = {"id": None}
+
+MEMBER_STATUSES = ("member", "administrator", "owner", "restricted")
+MEMBERSHIP_POSITIVE_TTL = 3600
+MEMBERSHIP_NEGATIVE_TTL = 30
+MEMBERSHIP_ERROR_BACKOFF = 10
+CHANNEL_SYNC_INTERVAL = 1800  # پیمایش کامل کانال فقط برای هماهنگ‌سازی گاه‌به‌گاه است
+CHANNEL_MEMBERS_FLUSH_INTERVAL = 60
+CHANNEL_SYNC_RECHECK_LIMIT = 200
+LOBBY_EDIT_DELAY = 1.5
+ANSWER_BATCH_WINDOW = 0.005
+ANSWER_BATCH_SIZE = 100
+PROCESSED_QUERIES_TTL = 300
+PROCESSED_QUERIES_BUCKETS = 10
+PROCESSED_QUERIES_MAX = 100000
+OUTBOUND_CONCURRENCY = 16
+OUTBOUND_RATE = 25  # تلگرام حدود ۳۰ درخواست در ثانیه را برای هر ربات می‌پذیرد
+OUTBOUND_ANSWER_RATE = 30  # پاسخ دکمه‌ها سطل جدا دارند و از سهم ارسال و ویرایش پیام کم نمی‌کنند
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+
+PRIORITY_CALLBACK = 0
+PRIORITY_GAME = 1
+PRIORITY_LOBBY = 2
+PRIORITY_BROADCAST = 3
+
+LEADERBOARD_MIN_INTERVAL = 30
+LEADERBOARD_MAX_INTERVAL = 1800
+LEADERBOARD_RETENTION_DAYS = 7  # باید دست‌کم کل هفته جاری را نگه دارد تا جدول هفتگی از سطرهای روزانه ساخته شود
+ROLLUP_DAYS_PER_RUN = 7
 
 TOPIC_TO_TABLE = {
     "topic_economics": "questions_calan",
@@ -51,6 +100,17 @@ TOPIC_TO_PERSIAN = {
     "topic_econthought_history": "تاریخ عقاید اقتصادی",
 }
 
+OPTION_TO_INDEX = {"option_1": 1, "option_2": 2}
+
+LEADERBOARD_WINDOWS = {
+    "today": "امروز",
+    "week": "این هفته",
+    "season": "این فصل",
+    "alltime": "همه دوران",
+}
+# یک پیام سنجاق‌شده که هر بار جدول یکی از بازه‌ها را به نوبت نشان می‌دهد
+leaderboard_announcement = {"message_id": None, "hash": None, "window": None, "version": None, "pinned": False}
+
 original_methods = {
     'send_message': Client.send_message,
     'edit_message_text': Client.edit_message_text,
@@ -84,6 +144,143 @@ def wrap_method(method_name, original_method):
 for method_name, original_method in original_methods.items():
     setattr(Client, method_name, wrap_method(method_name, original_method))
 
+def normalize_text(text):
+    return text.replace("\\n", "\n") if text else ""
+
+class TopicQuestions:
+    __slots__ = ("topic", "table_name", "ids", "questions", "options1", "options2", "correct_options")
+
+    def __init__(self, topic, table_name):
+        self.topic = topic
+        self.table_name = table_name
+        self.ids = array("q")
+        self.questions = []
+        self.options1 = []
+        self.options2 = []
+        self.correct_options = array("b")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, question_id, question, option1, option2, correct_answer):
+        # متن‌ها یک بار هنگام بارگذاری نرمال می‌شوند و گزینه درست به عدد ۱ یا ۲ تبدیل می‌شود
+        correct_option = int(correct_answer.strip()[-1])
+        if correct_option not in (1, 2):
+            raise ValueError(f"Invalid correct_answer {correct_answer!r} for question {question_id}")
+        self.ids.append(question_id)
+        self.questions.append(normalize_text(question))
+        self.options1.append(normalize_text(option1))
+        self.options2.append(normalize_text(option2))
+        self.correct_options.append(correct_option)
+
+    def get(self, idx):
+        return self.questions[idx], self.options1[idx], self.options2[idx], self.correct_options[idx]
+
+class QuestionBank:
+    # همه جدول‌های سوالات یک بار در شروع ربات در حافظه بارگذاری می‌شوند
+    def __init__(self):
+        self.topics = {}
+
+    def load(self, conn):
+        topics = {}
+        cursor = conn.cursor()
+        for topic, table_name in TOPIC_TO_TABLE.items():
+            bank = TopicQuestions(topic, table_name)
+            try:
+                cursor.execute(f"SELECT id, question, option1, option2, correct_answer FROM {table_name} ORDER BY id")
+                for row in cursor:
+                    try:
+                        bank.append(*row)
+                    except (ValueError, AttributeError) as e:
+                        logger.error(f"Skipping question in {table_name}: {str(e)}")
+            except sqlite3.Error as e:
+                logger.error(f"Error loading questions from {table_name}: {str(e)}")
+            topics[topic] = bank
+            logger.info(f"Loaded {len(bank)} questions for {topic} from {table_name}")
+        self.topics = topics
+        return sum(len(bank) for bank in topics.values())
+
+    def sample(self, topics, total, used):
+        # یک تخصیص برای همه موضوعات؛ سهم موضوعی که سوال کم دارد به بقیه می‌رسد
+        banks = [self.topics[topic] for topic in dict.fromkeys(topics) if len(self.topics.get(topic, ()))]
+        capacities = {bank.topic: len(bank) - used.count(bank.topic) for bank in banks}
+        if sum(capacities.values()) < total:
+            for bank in banks:
+                used.reset(bank.topic)
+            capacities = {bank.topic: len(bank) for bank in banks}
+        allocation = allocate_questions(capacities, total)
+        questions = []
+        for bank in banks:
+            if allocation[bank.topic]:
+                questions.extend(bank.get(idx) for idx in used.sample(bank, allocation[bank.topic]))
+        random.shuffle(questions)
+        return questions
+
+def allocate_questions(capacities, total):
+    allocation = {}
+    remaining = min(total, sum(capacities.values()))
+    pending = sorted(capacities, key=lambda topic: (capacities[topic], random.random()))
+    for i, topic in enumerate(pending):
+        share = -(-remaining // (len(pending) - i))
+        allocation[topic] = min(capacities[topic], share)
+        remaining -= allocation[topic]
+    return allocation
+
+question_bank = QuestionBank()
+
+class UsedQuestions:
+    # برای هر موضوع یک بیت به ازای هر شناسه سوال؛ حافظه به طول متن سوالات وابسته نیست
+    __slots__ = ("bits", "counts")
+
+    def __init__(self):
+        self.bits = {}
+        self.counts = {}
+
+    def count(self, topic):
+        return self.counts.get(topic, 0)
+
+    def is_used(self, topic, question_id):
+        bits = self.bits.get(topic)
+        if bits is None or question_id >> 3 >= len(bits):
+            return False
+        return bool(bits[question_id >> 3] & (1 << (question_id & 7)))
+
+    def mark(self, topic, question_id):
+        bits = self.bits.get(topic)
+        if bits is None:
+            bits = self.bits[topic] = bytearray()
+        if question_id >> 3 >= len(bits):
+            bits.extend(bytes((question_id >> 3) + 1 - len(bits)))
+        mask = 1 << (question_id & 7)
+        if not bits[question_id >> 3] & mask:
+            bits[question_id >> 3] |= mask
+            self.counts[topic] = self.counts.get(topic, 0) + 1
+
+    def reset(self, topic):
+        self.bits.pop(topic, None)
+        self.counts.pop(topic, None)
+
+    def sample(self, bank, k):
+        # نمونه‌گیری با رد کردن سوالات تکراری: به طور میانگین O(k) تا وقتی بیشتر سوالات آزادند
+        topic, ids = bank.topic, bank.ids
+        n = len(ids)
+        free = n - self.count(topic)
+        if k > free:
+            raise ValueError(f"Only {free} unused questions left for {topic}")
+        selected = []
+        if free * 4 < n:
+            candidates = [idx for idx in range(n) if not self.is_used(topic, ids[idx])]
+            selected = random.sample(candidates, k)
+            for idx in selected:
+                self.mark(topic, ids[idx])
+            return selected
+        while len(selected) < k:
+            idx = random.randrange(n)
+            if not self.is_used(topic, ids[idx]):
+                self.mark(topic, ids[idx])
+                selected.append(idx)
+        return selected
+
 class Game:
     def __init__(self, owner_id):
         self.game_id = str(uuid.uuid4())
@@ -95,8 +292,9 @@ class Game:
         self.last_updated = datetime.now()
         self.current_question = 0
         self.questions = []
+        self.question_screens = []
         self.scores = {}
-        self.used_questions = set()  # هر بازی مجموعه سوالات استفاده‌شده خودش را دارد
+        self.used_questions = UsedQuestions()  # هر بازی بیت‌ست سوالات استفاده‌شده خودش را دارد
 
     def update_timestamp(self):
         self.last_updated = datetime.now()
@@ -113,41 +311,54 @@ class Game:
     def get_total_questions(self):
         return int(self.selections["number"][4:]) if self.selections["number"] else 0
 
-    def get_random_questions(self, table_name, num_questions):
-        db_path = "plugins/questions.db"
-        try:
-            if not os.path.exists(db_path):
-                raise FileNotFoundError(f"فایل پایگاه داده {db_path} پیدا نشد!")
-            with sqlite3.connect(db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(f"SELECT question, option1, option2, correct_answer FROM {table_name}")
-                questions = cursor.fetchall()
-            available_questions = [q for q in questions if str(q) not in self.used_questions]
-            if len(available_questions) < num_questions:
-                self.used_questions.clear()
-                available_questions = questions
-            if len(available_questions) < num_questions:
-                raise ValueError(f"تعداد سوالات کافی در جدول {table_name} وجود ندارد!")
-            selected_questions = random.sample(available_questions, num_questions)
-            processed_questions = []
-            for question, option1, option2, correct_answer in selected_questions:
-                question = question.replace("\\n", "\n")
-                option1 = option1.replace("\\n", "\n")
-                option2 = option2.replace("\\n", "\n")
-                correct_answer = correct_answer.replace("\\n", "\n")
-                processed_questions.append((question, option1, option2, correct_answer))
-                self.used_questions.add(str((question, option1, option2, correct_answer)))
-            return processed_questions
-        except Exception as e:
-            logger.error(f"Error getting random questions: {str(e)}")
-            return []
-
 games = {}
 
-def init_leaderboard_db():
-    db_path = "plugins/questions.db"
+class Database:
+    # همه کارهای sqlite روی نخ‌های جداگانه با اتصال دائمی انجام می‌شود تا حلقه رویداد هیچ‌وقت بلاک نشود.
+    # یک نخ نویسنده و چند نخ خواننده؛ در حالت WAL نوشتن جدول امتیازات خواندن سوالات را بلاک نمی‌کند
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=67108864",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+    )
+
+    def __init__(self, db_path="plugins/questions.db", readers=2):
+        self.db_path = db_path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-reader")
+        self._local = threading.local()
+
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.db_path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    def _call(self, readonly, fn, args):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly)
+        return fn(conn, *args)
+
+    def call(self, fn, *args):
+        return self._writer.submit(self._call, False, fn, args).result()
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._call, True, fn, args)
+
+    async def write(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._call, False, fn, args)
+
+db = Database()
+
+def init_leaderboard_db(conn):
     try:
-        with sqlite3.connect(db_path) as conn:
+        with conn:
             cursor = conn.cursor()
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS leaderboard (
@@ -158,225 +369,935 @@ def init_leaderboard_db():
                     PRIMARY KEY (user_id, game_date)
                 )
             """)
-            conn.commit()
+            # مجموع امتیاز هر کاربر همراه با آخرین نامش هنگام ذخیره امتیازها به‌روز نگه داشته می‌شود
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_totals (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    total_correct INTEGER NOT NULL DEFAULT 0,
+                    last_game_date TEXT
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_totals_rank ON user_totals(total_correct DESC, username)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_leaderboard_game_date ON leaderboard(game_date)")
+            # سطرهای روزانه قدیمی در مجموع فصل فشرده می‌شوند و فصل‌های بسته‌شده همین‌جا بایگانی می‌مانند
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS seasons (
+                    season_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started_at TEXT NOT NULL,
+                    closed_at TEXT
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS season_totals (
+                    season_id INTEGER,
+                    user_id INTEGER,
+                    username TEXT,
+                    correct_answers INTEGER NOT NULL,
+                    PRIMARY KEY (season_id, user_id)
+                ) WITHOUT ROWID
+            """)
+            get_open_season(conn)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS channel_members (
+                    user_id INTEGER PRIMARY KEY,
+                    last_updated TEXT,
+                    status TEXT
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            if cursor.execute("SELECT 1 FROM user_totals LIMIT 1").fetchone() is None:
+                cursor.execute("""
+                    INSERT INTO user_totals (user_id, username, total_correct, last_game_date)
+                    SELECT user_id, username, total_correct, game_date
+                    FROM (
+                        SELECT user_id, username, game_date,
+                               SUM(correct_answers) OVER (PARTITION BY user_id) AS total_correct,
+                               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY game_date DESC) AS rn
+                        FROM leaderboard
+                    )
+                    WHERE rn = 1
+                """)
     except Exception as e:
         logger.error(f"Error initializing leaderboard DB: {str(e)}")
 
-def save_player_score(user_id, username, correct_answers):
-    db_path = "plugins/questions.db"
+def get_open_season(conn):
+    row = conn.execute("SELECT season_id FROM seasons WHERE closed_at IS NULL ORDER BY season_id DESC LIMIT 1").fetchone()
+    if row:
+        return row[0]
+    return conn.execute("INSERT INTO seasons (started_at) VALUES (?)",
+                        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)).lastrowid
+
+def rollup_leaderboard(conn, cutoff_date, max_days=ROLLUP_DAYS_PER_RUN):
+    # هر بار چند روز قدیمی‌تر از cutoff_date، هر روز در یک تراکنش جدا، به season_totals منتقل می‌شود
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-            game_date = datetime.now().strftime("%Y-%m-%d")
-            cursor.execute("SELECT correct_answers FROM leaderboard WHERE user_id = ? AND game_date = ?",
-                           (user_id, game_date))
-            result = cursor.fetchone()
-            if result:
-                existing_correct_answers = result[0]
-                total_correct_answers = existing_correct_answers + correct_answers
-                cursor.execute(
-                    "UPDATE leaderboard SET correct_answers = ?, username = ? WHERE user_id = ? AND game_date = ?",
-                    (total_correct_answers, username, user_id, game_date))
-            else:
-                cursor.execute(
-                    "INSERT INTO leaderboard (user_id, username, correct_answers, game_date) VALUES (?, ?, ?, ?)",
-                    (user_id, username, correct_answers, game_date))
-            conn.commit()
+        with conn:
+            season_id = get_open_season(conn)
+        days = [row[0] for row in conn.execute(
+            "SELECT DISTINCT game_date FROM leaderboard WHERE game_date < ? ORDER BY game_date LIMIT ?",
+            (cutoff_date, max_days))]
+        for game_date in days:
+            with conn:
+                conn.execute(
+                    """
+                    INSERT INTO season_totals (season_id, user_id, username, correct_answers)
+                    SELECT ?, user_id, username, correct_answers FROM leaderboard WHERE game_date = ?
+                    ON CONFLICT(season_id, user_id) DO UPDATE SET
+                        correct_answers = correct_answers + excluded.correct_answers,
+                        username = excluded.username
+                    """, (season_id, game_date))
+                conn.execute("DELETE FROM leaderboard WHERE game_date = ?", (game_date,))
+        return season_id, len(days)
     except Exception as e:
-        logger.error(f"Error saving player score: {str(e)}")
+        logger.error(f"Error rolling up leaderboard: {str(e)}")
+        return None, 0
 
-def get_leaderboard():
-    db_path = "plugins/questions.db"
+def save_game_scores(conn, scores):
+    # امتیاز همه بازیکنان یک بازی در یک تراکنش ذخیره می‌شود
+    game_date = datetime.now().strftime("%Y-%m-%d")
+    rows = [(user_id, username, correct_answers, game_date) for user_id, username, correct_answers in scores]
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
+        with conn:
+            conn.executemany(
                 """
-                SELECT user_id, SUM(correct_answers) as total_correct
-                FROM leaderboard
-                GROUP BY user_id
-                ORDER BY total_correct DESC
-                LIMIT 50
+                INSERT INTO leaderboard (user_id, username, correct_answers, game_date) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, game_date) DO UPDATE SET
+                    correct_answers = correct_answers + excluded.correct_answers,
+                    username = excluded.username
+                """, rows)
+            conn.executemany(
                 """
-            )
-            results = cursor.fetchall()
-            leaderboard = []
-            for user_id, total_correct in results:
-                cursor.execute(
-                    """
-                    SELECT username
+                INSERT INTO user_totals (user_id, username, total_correct, last_game_date) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_correct = total_correct + excluded.total_correct,
+                    username = excluded.username,
+                    last_game_date = excluded.last_game_date
+                """, rows)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving game scores: {str(e)}")
+        return False
+
+def load_user_totals(conn):
+    try:
+        return conn.execute(
+            """
+            SELECT user_id, username, total_correct
+            FROM user_totals
+            ORDER BY total_correct DESC
+            """
+        ).fetchall()
+    except Exception as e:
+        logger.error(f"Error fetching leaderboard: {str(e)}")
+        return []
+
+def load_leaderboard_windows(conn, season_id, today, week_start):
+    try:
+        alltime = {}
+        for user_id, username, correct_answers in conn.execute(
+                "SELECT user_id, username, correct_answers FROM season_totals WHERE season_id <> ? ORDER BY season_id",
+                (season_id,)):
+            alltime[user_id] = (username, alltime.get(user_id, (None, 0))[1] + correct_answers)
+        season = load_user_totals(conn)
+        for user_id, username, total_correct in season:
+            alltime[user_id] = (username, alltime.get(user_id, (None, 0))[1] + total_correct)
+        return {
+            "today": conn.execute(
+                "SELECT user_id, username, correct_answers FROM leaderboard WHERE game_date = ?", (today,)).fetchall(),
+            "week": conn.execute(
+                """
+                SELECT user_id, username, total_correct
+                FROM (
+                    SELECT user_id, username,
+                           SUM(correct_answers) OVER (PARTITION BY user_id) AS total_correct,
+                           ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY game_date DESC) AS rn
                     FROM leaderboard
-                    WHERE user_id = ?
-                    ORDER BY game_date DESC
-                    LIMIT 1
-                    """,
-                    (user_id,)
+                    WHERE game_date >= ?
                 )
-                username = cursor.fetchone()[0]
-                leaderboard.append((username, total_correct))
-            return leaderboard
+                WHERE rn = 1
+                """, (week_start,)).fetchall(),
+            "season": season,
+            "alltime": [(user_id, username, total_correct) for user_id, (username, total_correct) in alltime.items()],
+        }
     except Exception as e:
-        logger.error(f"Error fetching leaderboard: {str(e)}")
+        logger.error(f"Error loading leaderboard windows: {str(e)}")
+        return {}
+
+def load_channel_members(conn):
+    try:
+        return conn.execute("SELECT user_id, last_updated, status FROM channel_members").fetchall()
+    except Exception as e:
+        logger.error(f"Error loading channel members: {str(e)}")
         return []
 
+def save_channel_members(conn, changes):
+    # changes: user_id -> entry برای عضو، یا None برای کاربری که کانال را ترک کرده
+    try:
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO channel_members (user_id, last_updated, status) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET last_updated = excluded.last_updated, status = excluded.status
+                """,
+                [(user_id, entry["last_updated"], entry["status"]) for user_id, entry in changes.items() if entry])
+            conn.executemany("DELETE FROM channel_members WHERE user_id = ?",
+                             [(user_id,) for user_id, entry in changes.items() if entry is None])
+        return True
+    except Exception as e:
+        logger.error(f"Error saving channel members: {str(e)}")
+        return False
+
+def load_bot_state(conn):
+    try:
+        return dict(conn.execute("SELECT key, value FROM bot_state").fetchall())
+    except Exception as e:
+        logger.error(f"Error loading bot state: {str(e)}")
+        return {}
+
+def save_bot_state(conn, values):
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                list(values.items()))
+    except Exception as e:
+        logger.error(f"Error saving bot state: {str(e)}")
+
+class RankedLeaderboard:
+    # جدول امتیازات در حافظه: نگاشت کاربر به امتیاز و یک لیست مرتب بر اساس امتیاز
+    def __init__(self):
+        self.scores = {}
+        self.ranking = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def seed(self, rows):
+        self.scores = {user_id: (total_correct, username) for user_id, username, total_correct in rows}
+        self.ranking = sorted((-total_correct, user_id) for user_id, (total_correct, _) in self.scores.items())
+
+    def clear(self):
+        self.scores = {}
+        self.ranking = []
+
+    def add(self, user_id, username, correct_answers):
+        total_correct = correct_answers
+        previous = self.scores.get(user_id)
+        if previous is not None:
+            total_correct += previous[0]
+            del self.ranking[bisect_left(self.ranking, (-previous[0], user_id))]
+        self.scores[user_id] = (total_correct, username)
+        insort(self.ranking, (-total_correct, user_id))
+
+    def top(self, k=50):
+        return [(self.scores[user_id][1], -score) for score, user_id in self.ranking[:k]]
+
+    def rank(self, user_id):
+        # کاربرانی که امتیاز برابر دارند رتبه یکسان می‌گیرند
+        entry = self.scores.get(user_id)
+        if entry is None:
+            return None
+        return bisect_left(self.ranking, (-entry[0],)) + 1
+
+def leaderboard_window_keys(now=None):
+    # هفته در ایران از شنبه شروع می‌شود
+    now = now or datetime.now()
+    week_start = now - timedelta(days=(now.weekday() - 5) % 7)
+    return now.strftime("%Y-%m-%d"), week_start.strftime("%Y-%m-%d")
+
+class LeaderboardWindows:
+    # برای هر بازه زمانی یک جدول جدا در حافظه که هنگام ذخیره امتیازها به‌روز می‌شود؛
+    # جدول روزانه و هفتگی با شروع روز یا هفته جدید خالی می‌شوند
+    def __init__(self):
+        self.boards = {window: RankedLeaderboard() for window in LEADERBOARD_WINDOWS}
+        self.keys = (None, None)
+        self.version = 0
+
+    def __len__(self):
+        return len(self.boards["season"])
+
+    def _roll(self):
+        today, week_start = keys = leaderboard_window_keys()
+        if keys == self.keys:
+            return
+        if today != self.keys[0]:
+            self.boards["today"].clear()
+        if week_start != self.keys[1]:
+            self.boards["week"].clear()
+        self.keys = keys
+        self.version += 1
+
+    def seed(self, rows_by_window, keys):
+        for window, board in self.boards.items():
+            board.seed(rows_by_window.get(window, []))
+        self.keys = keys
+        self.version += 1
+
+    def add(self, user_id, username, correct_answers):
+        self._roll()
+        for board in self.boards.values():
+            board.add(user_id, username, correct_answers)
+        self.version += 1
+
+    def current_version(self):
+        # شمارنده با هر امتیاز تازه یا شروع روز و هفته جدید بالا می‌رود
+        self._roll()
+        return self.version
+
+    def top(self, window="season", k=50):
+        self._roll()
+        return self.boards[window].top(k)
+
+    def rank(self, user_id, window="season"):
+        self._roll()
+        return self.boards[window].rank(user_id)
+
+leaderboard_cache = LeaderboardWindows()
+
+def seed_leaderboard_cache(conn):
+    keys = leaderboard_window_keys()
+    leaderboard_cache.seed(load_leaderboard_windows(conn, current_season["id"], *keys), keys)
+
 def check_member_in_cache(user_id):
-    return channel_members_cache.get(user_id, {}).get("status")
+    entry = channel_members_cache.get(user_id)
+    if entry is None or time.monotonic() - entry.get("checked_at", 0) > MEMBERSHIP_POSITIVE_TTL:
+        return None
+    return entry["status"]
 
-async def sync_channel_members(client):
+def remember_until(cache, user_id, ttl):
+    # همه مدخل‌های یک کش TTL یکسان دارند، پس ترتیب درج همان ترتیب انقضاست و منقضی‌ها همیشه در ابتدای دیکشنری‌اند
+    now = time.monotonic()
+    while cache:
+        oldest = next(iter(cache))
+        if cache[oldest] > now:
+            break
+        del cache[oldest]
+    cache.pop(user_id, None)
+    cache[user_id] = now + ttl
+
+def remember_non_member(user_id):
+    remember_until(membership_negative_cache, user_id, MEMBERSHIP_NEGATIVE_TTL)
+
+def stale_member_status(user_id):
+    # وقتی تلگرام در دسترس نیست آخرین وضعیت شناخته‌شده، حتی اگر TTL آن گذشته باشد، بهتر از رد کردن عضو است
+    entry = channel_members_cache.get(user_id)
+    return entry["status"] if entry else None
+
+async def fetch_member_status(client, user_id):
     try:
-        async with channel_members_lock:
-            channel_members_cache.clear()
-            async for member in client.get_chat_members("@chalesh_yarr"):
-                try:
-                    user_id = member.user.id
-                    status = member.status.value
-                    channel_members_cache[user_id] = {
-                        "status": status,
-                        "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                except Exception as e:
-                    logger.error(f"Error syncing member {user_id}: {str(e)}")
+        member = await client.get_chat_member("@chalesh_yarr", user_id)
+        status = member.status.value
+    except UserNotParticipant:
+        status = None
+    if status in MEMBER_STATUSES:
+        entry = channel_members_cache[user_id] = {
+            "status": status,
+            "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "checked_at": time.monotonic()
+        }
+        membership_negative_cache.pop(user_id, None)
+        channel_members_pending[user_id] = entry
+    else:
+        remember_non_member(user_id)
+        if channel_members_cache.pop(user_id, None) is not None:
+            channel_members_pending[user_id] = None
+    return status
+
+async def get_member_status(client, user_id):
+    # اول کش؛ در صورت نبودن فقط همین کاربر از تلگرام پرسیده می‌شود و درخواست‌های هم‌زمان یکی می‌شوند
+    status = check_member_in_cache(user_id)
+    if status:
+        return status
+    now = time.monotonic()
+    if membership_negative_cache.get(user_id, 0) > now:
+        return None
+    if membership_flood["until"] > now or membership_lookup_failures.get(user_id, 0) > now:
+        return stale_member_status(user_id)
+    task = membership_lookups.get(user_id)
+    if task is None:
+        task = membership_lookups[user_id] = asyncio.ensure_future(fetch_member_status(client, user_id))
+        task.add_done_callback(lambda _: membership_lookups.pop(user_id, None))
+    try:
+        return await asyncio.shield(task)
+    except FloodWait as e:
+        # FloodWait برای کل ربات است؛ تا پایان آن هیچ استعلام تکی فرستاده نمی‌شود
+        membership_flood["until"] = max(membership_flood["until"], time.monotonic() + e.value)
+        logger.warning(f"FloodWait {e.value}s while checking membership of {user_id}")
+        return stale_member_status(user_id)
     except Exception as e:
-        logger.error(f"Error syncing channel members: {str(e)}")
+        remember_until(membership_lookup_failures, user_id, MEMBERSHIP_ERROR_BACKOFF)
+        logger.error(f"Error checking membership of {user_id}: {str(e)}")
+        return stale_member_status(user_id)
 
-async def update_channel_members_periodically(client):
-    while True:
+async def sync_channel_members(client):
+    # لیست جدید جداگانه ساخته می‌شود و در پایان یک‌جا جایگزین می‌شود تا کش هیچ‌وقت خالی یا نیمه‌کاره دیده نشود
+    global channel_members_cache, channel_members_diff
+    async with channel_members_lock:
+        new_cache = {}
+        async for member in client.get_chat_members("@chalesh_yarr"):
+            try:
+                user_id = member.user.id
+                status = member.status.value
+                new_cache[user_id] = {
+                    "status": status,
+                    "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "checked_at": time.monotonic()
+                }
+            except Exception as e:
+                logger.error(f"Error syncing member {user_id}: {str(e)}")
+        old_cache = channel_members_cache
+        # تلگرام فهرست کانال‌های بزرگ را کوتاه برمی‌گرداند، پس نبودن در فهرست به معنای خروج نیست:
+        # مدخل‌ها نگه داشته می‌شوند و آن‌هایی که TTL مثبتشان گذشته تک‌به‌تک دوباره بررسی می‌شوند
+        now = time.monotonic()
+        recheck = []
+        for user_id, entry in old_cache.items():
+            if user_id in new_cache:
+                continue
+            new_cache[user_id] = entry
+            if now - entry.get("checked_at", 0) > MEMBERSHIP_POSITIVE_TTL:
+                recheck.append(user_id)
+        channel_members_cache = new_cache
+        channel_members_diff = {
+            "joined": new_cache.keys() - old_cache.keys(),
+            "left": set(),
+        }
+        # فقط تغییرات در جدول channel_members نوشته می‌شود
+        for user_id, entry in new_cache.items():
+            if user_id in channel_members_diff["joined"] or old_cache[user_id]["status"] != entry["status"]:
+                channel_members_pending[user_id] = entry
+    # خروج فقط با استعلام تکی تأیید می‌شود؛ fetch_member_status مدخل و سطر channel_members را حذف می‌کند
+    for user_id in recheck[:CHANNEL_SYNC_RECHECK_LIMIT]:
         try:
-            await sync_channel_members(client)
-            await asyncio.sleep(5)
+            if await fetch_member_status(client, user_id) not in MEMBER_STATUSES:
+                channel_members_diff["left"].add(user_id)
+        except FloodWait:
+            raise
         except Exception as e:
-            logger.error(f"Error in update_channel_members_periodically: {str(e)}")
-            await asyncio.sleep(5)
+            logger.error(f"Error rechecking member {user_id}: {str(e)}")
+    if channel_members_diff["joined"] or channel_members_diff["left"]:
+        logger.info(f"Channel members synced: {len(channel_members_cache)} members, "
+                    f"{len(channel_members_diff['joined'])} joined, {len(channel_members_diff['left'])} left")
 
-async def process_queued_actions(client: Client):
-    while True:
-        try:
-            actions = []
-            while not answer_queue.empty():
-                action = await answer_queue.get()
-                actions.append(action)
-
-            if actions:
-                for action in actions:
-                    callback_query_id = action['callback_query_id']
-                    action_type = action.get('type', 'answer')
-                    text = action['text']
-                    show_alert = action.get('show_alert', False)
-
-                    if action_type == 'answer':
-                        game_id = action['game_id']
-                        user_id = action['user_id']
-                        pure_data = action['pure_data']
-                        game = games.get(game_id)
-                        if not game:
-                            logger.warning(f"Game {game_id} not found for answer processing")
-                            continue
-                        current_question = game.current_question
-                        if current_question not in game.choices:
-                            game.choices[current_question] = {}
-                        if user_id in game.choices[current_question]:
-                            text = "⚠️ شما قبلاً برای این سوال گزینه‌ای انتخاب کرده‌اید"
-                            show_alert = False
-                        else:
-                            game.choices[current_question][user_id] = pure_data
-                            question_text, _, _, correct_answer = game.questions[current_question - 1]
-                            is_correct = pure_data[-1] == correct_answer[-1]
-                            if is_correct:
-                                game.scores[user_id] = game.scores.get(user_id, 0) + 1
-                            text = "✅ پاسخ درست!" if is_correct else "❌ پاسخ نادرست!"
-                            show_alert = False
-                            logger.info(f"Processed answer for user {user_id} in game {game_id}: {pure_data}, Correct: {is_correct}")
+class RecentKeys:
+    # تشخیص تکرار با پنجره لغزان: کلیدها در سطل‌های زمانی نگه داشته می‌شوند و با گذشت ttl
+    # قدیمی‌ترین سطل کنار می‌رود؛ اگر سطل جاری پر شود زودتر می‌چرخد تا حافظه از max_size بیشتر نشود
+    def __init__(self, ttl, buckets, max_size):
+        self.span = ttl / buckets
+        self.bucket_size = max(1, max_size // buckets)
+        self.buckets = deque([set()], maxlen=buckets)
+        self.bucket_started = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _rotate(self, now):
+        steps = min(int((now - self.bucket_started) // self.span), self.buckets.maxlen)
+        if len(self.buckets[-1]) >= self.bucket_size:
+            steps = max(steps, 1)
+        for _ in range(steps):
+            if len(self.buckets) == self.buckets.maxlen:
+                self.evicted += len(self.buckets[0])
+            self.buckets.append(set())
+        if steps:
+            self.bucket_started = now
+
+    def seen(self, key):
+        # True اگر کلید در پنجره اخیر دیده شده باشد؛ در غیر این صورت ثبت می‌شود
+        self._rotate(time.monotonic())
+        for bucket in reversed(self.buckets):
+            if key in bucket:
+                self.hits += 1
+                return True
+        self.misses += 1
+        self.buckets[-1].add(key)
+        return False
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def summary(self):
+        return f"size={len(self)}, hits={self.hits}, misses={self.misses}, evicted={self.evicted}"
+
+processed_queries = RecentKeys(PROCESSED_QUERIES_TTL, PROCESSED_QUERIES_BUCKETS, PROCESSED_QUERIES_MAX)
 
+class TokenBucket:
+    # محدودکننده نرخ: حداکثر rate درخواست در ثانیه با ظرفیت انفجاری capacity
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def delay(self):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def try_acquire(self):
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def idle(self):
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class OutboundScheduler:
+    # همه درخواست‌های نوشتنی به تلگرام از این صف عبور می‌کنند. کارهای هر کلید (چت یا پیام) به ترتیب ورود
+    # ارسال می‌شوند و کلید با بهترین اولویت کارهایش زودتر نوبت می‌گیرد؛ کلیدهای هم‌اولویت به نوبت سرویس
+    # می‌گیرند. پاسخ دکمه‌ها (کلید None) سطل جداگانه خودشان را دارند تا سهم ویرایش سوال‌ها را نخورند
+    def __init__(self, rate, answer_rate, chat_rate, chat_burst, concurrency, priorities=4):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.answer_bucket = TokenBucket(answer_rate, answer_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.chats = OrderedDict()
+        self.in_flight = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        self.sent = [0] * priorities
+
+    def submit(self, priority, chat_key, factory):
+        future = asyncio.get_running_loop().create_future()
+        self.chats.setdefault(chat_key, deque()).append((priority, factory, future, 0))
+        self.wakeup.set()
+        return future
+
+    def queued(self):
+        return sum(len(jobs) for jobs in self.chats.values())
+
+    def _chat_bucket(self, chat_key):
+        # ترتیب برای هر پیام جداست ولی محدودیت نرخ تلگرام برای کل چت است؛ کلید (chat_id, message_id)
+        # از سطل همان chat_id برداشت می‌کند و پیام‌های inline سطل خودشان را دارند
+        rate_key = chat_key[0] if isinstance(chat_key, tuple) else chat_key
+        bucket = self.chat_buckets.get(rate_key)
+        if bucket is None:
+            bucket = self.chat_buckets[rate_key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _delay(self, chat_key):
+        if chat_key is None:
+            return self.answer_bucket.delay()
+        return max(self.global_bucket.delay(), self._chat_bucket(chat_key).delay())
+
+    def _acquire(self, chat_key):
+        if chat_key is None:
+            self.answer_bucket.try_acquire()
+        else:
+            self.global_bucket.try_acquire()
+            self._chat_bucket(chat_key).try_acquire()
+
+    def _next(self):
+        # برگرداندن اولین کار آماده و کمترین زمان انتظار برای کارهایی که هنوز آماده نیستند
+        best = wait = None
+        empty = []
+        for chat_key, jobs in self.chats.items():
+            while jobs and jobs[0][2].cancelled():
+                jobs.popleft()
+            if not jobs:
+                empty.append(chat_key)
+                continue
+            # تا کار قبلی همین کلید تمام نشده کار بعدی شروع نمی‌شود تا ترتیب رسیدن به تلگرام حفظ شود
+            if chat_key in self.in_flight:
+                continue
+            priority = min(job[0] for job in jobs)
+            if best is not None and priority >= best[0]:
+                continue
+            delay = self._delay(chat_key)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            best = (priority, chat_key)
+        for chat_key in empty:
+            del self.chats[chat_key]
+        if best is None:
+            return None, wait
+        chat_key = best[1]
+        self._acquire(chat_key)
+        if chat_key is not None:
+            self.in_flight.add(chat_key)
+        jobs = self.chats[chat_key]
+        job = jobs.popleft()
+        if jobs:
+            self.chats.move_to_end(chat_key)
+        else:
+            del self.chats[chat_key]
+        return (chat_key,) + job, None
+
+    def _prune(self):
+        if len(self.chat_buckets) > 1000:
+            queued = {chat_key[0] if isinstance(chat_key, tuple) else chat_key for chat_key in self.chats}
+            for rate_key in [key for key, bucket in self.chat_buckets.items()
+                             if key not in queued and bucket.idle()]:
+                del self.chat_buckets[rate_key]
+
+    async def run(self):
+        while True:
+            try:
+                job, wait = self._next()
+                if job is None:
+                    self._prune()
+                    self.wakeup.clear()
                     try:
-                        await client.answer_callback_query(
-                            callback_query_id=callback_query_id,
-                            text=text,
-                            show_alert=show_alert
-                        )
-                        logger.info(f"Processed action: {text} for callback {callback_query_id}")
-                    except QueryIdInvalid:
-                        logger.warning(f"Invalid callback query ID: {callback_query_id}")
-                    except Exception as e:
-                        logger.error(f"Failed to process action: {e}")
+                        await asyncio.wait_for(self.wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.semaphore.acquire()
+                task = asyncio.create_task(self._execute(*job))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            except Exception as e:
+                logger.error(f"Error in outbound scheduler: {str(e)}")
 
-                logger.info(f"Processed {len(actions)} queued actions")
+    async def _execute(self, chat_key, priority, factory, future, attempt):
+        try:
+            # کاری که منتظرش لغو شده (مثلاً بازی لغو شده) دیگر به تلگرام فرستاده نمی‌شود
+            if future.cancelled():
+                return
+            result = await factory()
+            self.sent[priority] += 1
+            if not future.done():
+                future.set_result(result)
+        except FloodWait as e:
+            (self.answer_bucket if chat_key is None else self._chat_bucket(chat_key)).pause(e.value)
+            logger.warning(f"FloodWait {e.value}s for chat {chat_key} (priority {priority})")
+            if attempt == 0 and not future.done():
+                self.chats.setdefault(chat_key, deque()).appendleft((priority, factory, future, 1))
+                self.chats.move_to_end(chat_key, last=False)
+                self.wakeup.set()
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.semaphore.release()
+            if chat_key is not None:
+                self.in_flight.discard(chat_key)
+                self.wakeup.set()
+
+outbound = OutboundScheduler(OUTBOUND_RATE, OUTBOUND_ANSWER_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_CONCURRENCY)
+
+def callback_message_key(callback_query):
+    if callback_query.inline_message_id:
+        return callback_query.inline_message_id
+    return callback_query.message.chat.id, callback_query.message.id
+
+async def answer_callback(callback_query, text, show_alert=False):
+    return await outbound.submit(PRIORITY_CALLBACK, None,
+                                 lambda: callback_query.answer(text, show_alert=show_alert))
 
-            await asyncio.sleep(3)
+async def edit_callback_message(callback_query, priority, *args, **kwargs):
+    return await outbound.submit(priority, callback_message_key(callback_query),
+                                 lambda: callback_query.edit_message_text(*args, **kwargs))
+
+class PeriodicJob:
+    # اجرای دوره‌ای یک کار پس‌زمینه با فاصله تصادفی، عقب‌نشینی نمایی پس از خطا و رعایت FloodWait
+    def __init__(self, name, func, interval, jitter=0.1, max_backoff=3600, initial_delay=0,
+                 wake_event=None, min_interval=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max(max_backoff, interval)
+        self.initial_delay = initial_delay
+        self.wake_event = wake_event
+        self.min_interval = min_interval
+        self.task = None
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.next_delay = initial_delay
+
+    def start(self):
+        background_jobs[self.name] = self
+        self.task = asyncio.create_task(self.run_forever())
+        return self.task
+
+    def summary(self):
+        average = self.total_duration / self.runs if self.runs else 0.0
+        return (f"runs={self.runs}, failures={self.failures}, last={self.last_duration:.3f}s, "
+                f"avg={average:.3f}s, next_delay={self.next_delay:.0f}s")
+
+    def _backoff(self):
+        return min(self.max_backoff, self.interval * 2 ** self.consecutive_failures)
+
+    async def _wait(self, delay, wakeable=True):
+        # رویداد بیدارباش فقط فاصله عادی را کوتاه می‌کند؛ انتظار پس از خطا یا FloodWait کامل رعایت می‌شود
+        if self.wake_event is None or not wakeable:
+            await asyncio.sleep(delay)
+            return
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), delay)
+        except asyncio.TimeoutError:
+            return
+        self.wake_event.clear()
+        await asyncio.sleep(self.min_interval)
+
+    async def run_forever(self):
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            started = time.monotonic()
+            floor = 0
+            try:
+                await self.func()
+                self.consecutive_failures = 0
+                delay = self.interval
+            except FloodWait as e:
+                self.failures += 1
+                self.consecutive_failures += 1
+                floor = e.value
+                delay = max(e.value, self._backoff())
+                logger.warning(f"FloodWait in {self.name}: waiting {delay}s")
+            except Exception as e:
+                self.failures += 1
+                self.consecutive_failures += 1
+                delay = self._backoff()
+                logger.error(f"Error in {self.name}: {str(e)}, retrying in {delay}s")
+            self.runs += 1
+            self.last_duration = time.monotonic() - started
+            self.total_duration += self.last_duration
+            self.next_delay = max(floor, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+            await self._wait(self.next_delay, wakeable=self.consecutive_failures == 0)
+
+async def flush_channel_members():
+    global channel_members_pending
+    if not channel_members_pending:
+        return
+    changes, channel_members_pending = channel_members_pending, {}
+    if not await db.write(save_channel_members, changes):
+        channel_members_pending = {**changes, **channel_members_pending}
+        raise RuntimeError(f"{len(changes)} channel member changes could not be saved")
+    logger.info(f"Persisted {len(changes)} channel member changes")
+
+def prepare_action(action):
+    # ثبت پاسخ بازیکن به ترتیب صف و بدون انتظار انجام می‌شود؛ فقط ارسال پاسخ به تلگرام هم‌زمان است
+    callback_query_id = action['callback_query_id']
+    action_type = action.get('type', 'answer')
+    text = action['text']
+    show_alert = action.get('show_alert', False)
+
+    if action_type == 'answer':
+        game_id = action['game_id']
+        user_id = action['user_id']
+        option = action['option']
+        game = games.get(game_id)
+        if not game:
+            logger.warning(f"Game {game_id} not found for answer processing")
+            return None
+        current_question = action.get('question') or game.current_question
+        if not current_question or not 1 <= current_question <= min(game.current_question or 0, len(game.questions)):
+            logger.warning(f"Answer for question {current_question} out of range in game {game_id}")
+            return callback_query_id, "⚠️ این سوال فعال نیست", False
+        if current_question not in game.choices:
+            game.choices[current_question] = {}
+        if user_id in game.choices[current_question]:
+            text = "⚠️ شما قبلاً برای این سوال گزینه‌ای انتخاب کرده‌اید"
+            show_alert = False
+        else:
+            game.choices[current_question][user_id] = option
+            is_correct = option == game.questions[current_question - 1][3]
+            if is_correct:
+                game.scores[user_id] = game.scores.get(user_id, 0) + 1
+            text = "✅ پاسخ درست!" if is_correct else "❌ پاسخ نادرست!"
+            show_alert = False
+            logger.info(f"Processed answer for user {user_id} in game {game_id}: option {option}, Correct: {is_correct}")
+    return callback_query_id, text, show_alert
+
+async def send_callback_answer(client: Client, callback_query_id, text, show_alert):
+    try:
+        await outbound.submit(PRIORITY_CALLBACK, None, lambda: client.answer_callback_query(
+            callback_query_id=callback_query_id,
+            text=text,
+            show_alert=show_alert
+        ))
+        logger.info(f"Processed action: {text} for callback {callback_query_id}")
+    except QueryIdInvalid:
+        logger.warning(f"Invalid callback query ID: {callback_query_id}")
+    except Exception as e:
+        logger.error(f"Failed to process action: {e}")
+
+async def process_queued_actions(client: Client):
+    # به محض رسیدن اولین درخواست بیدار می‌شود و چند میلی‌ثانیه برای جمع کردن درخواست‌های هم‌زمان صبر می‌کند
+    while True:
+        try:
+            actions = [await answer_queue.get()]
+            await asyncio.sleep(ANSWER_BATCH_WINDOW)
+            while len(actions) < ANSWER_BATCH_SIZE and not answer_queue.empty():
+                actions.append(answer_queue.get_nowait())
+            for action in actions:
+                answer = prepare_action(action)
+                if answer:
+                    task = asyncio.create_task(send_callback_answer(client, *answer))
+                    callback_answer_tasks.add(task)
+                    task.add_done_callback(callback_answer_tasks.discard)
+            if len(actions) > 1:
+                logger.info(f"Processed {len(actions)} queued actions")
         except Exception as e:
             logger.error(f"Error in process_queued_actions: {e}")
-            await asyncio.sleep(3)
 
 async def start_background_tasks(client):
     global bot_id
     try:
+        # صف خروجی باید پیش از هر کار دیگری راه بیفتد چون همه ارسال‌ها منتظر آن می‌مانند
+        outbound.tasks.add(asyncio.create_task(outbound.run()))
         bot_id = (await client.get_me()).id
-        asyncio.create_task(cleanup_expired_games())
-        asyncio.create_task(announce_leaderboard(client))
-        asyncio.create_task(update_channel_members_periodically(client))
-        asyncio.create_task(cleanup_processed_queries())
-        asyncio.create_task(log_request_summary())
+        for job in (
+            PeriodicJob("cleanup_expired_games", cleanup_expired_games, 300),
+            PeriodicJob("announce_leaderboard", lambda: announce_leaderboard(client), LEADERBOARD_MAX_INTERVAL,
+                        wake_event=leaderboard_changed, min_interval=LEADERBOARD_MIN_INTERVAL),
+            PeriodicJob("rollup_leaderboard", rollup_leaderboard_job, 3600),
+            # اگر کش از پایگاه داده بارگذاری شده باشد پیمایش کامل می‌تواند تا دور بعد صبر کند
+            PeriodicJob("sync_channel_members", lambda: sync_channel_members(client), CHANNEL_SYNC_INTERVAL,
+                        initial_delay=CHANNEL_SYNC_INTERVAL if channel_members_cache else 0),
+            PeriodicJob("flush_channel_members", flush_channel_members, CHANNEL_MEMBERS_FLUSH_INTERVAL,
+                        initial_delay=CHANNEL_MEMBERS_FLUSH_INTERVAL),
+            PeriodicJob("log_request_summary", log_request_summary, 300),
+        ):
+            job.start()
         asyncio.create_task(process_queued_actions(client))
     except Exception as e:
         logger.error(f"Error in starting background tasks: {str(e)}")
 
-async def cleanup_processed_queries():
-    while True:
-        processed_queries.clear()
-        await asyncio.sleep(3600)
-
 async def log_request_summary():
-    while True:
-        logger.info(f"Summary: Total API Requests={api_request_counter}, Failed Requests={failed_request_counter}")
-        await asyncio.sleep(300)
+    logger.info(f"Summary: Total API Requests={api_request_counter}, Failed Requests={failed_request_counter}")
+    for job in background_jobs.values():
+        logger.info(f"Job {job.name}: {job.summary()}")
+    logger.info(f"Processed queries: {processed_queries.summary()}")
+    logger.info(f"Outbound: sent per priority={outbound.sent}, "
+                f"queued={outbound.queued()}, "
+                f"chat buckets={len(outbound.chat_buckets)}")
 
-async def announce_leaderboard(client):
-    while True:
+def render_leaderboard(leaderboard, window="season"):
+    title = LEADERBOARD_WINDOWS[window]
+    if not leaderboard:
+        return f"🌟 **هنوز هیچ بازیکنی در رتبه‌بندی {title} ثبت نشده است!** 🌟\n" \
+               "🎮 بیا و در چالش یار شرکت کن تا نامت اینجا بدرخشه! ✨"
+    message = f"🌟 **جدول نفرات برتر چالش یار - {title}** 🌟\n\n"
+    for idx, (username, total_correct) in enumerate(leaderboard, 1):
+        if idx == 1:
+            medal = "🥇"
+        elif idx == 2:
+            medal = "🥈"
+        elif idx == 3:
+            medal = "🥉"
+        else:
+            medal = f"{idx}."
+        message += f"{medal} **{username}** - {total_correct} پاسخ درست 🎉\n"
+    message += "\n🏆 به جمع برترین‌ها بپیوندید! 🚀"
+    return message
+
+async def publish_leaderboard(client, window="season"):
+    # فقط وقتی جدول تغییر کرده پیام سنجاق‌شده ویرایش می‌شود؛ اگر پیامی نباشد پیام جدید فرستاده و سنجاق می‌شود
+    announcement = leaderboard_announcement
+    message = render_leaderboard(leaderboard_cache.top(window, 50), window)
+    digest = hashlib.sha1(message.encode("utf-8")).hexdigest()
+    if digest == announcement["hash"] and announcement["pinned"]:
+        return False
+    message_id = announcement["message_id"]
+    if message_id:
         try:
-            leaderboard = get_leaderboard()
-            if not leaderboard:
-                message = "🌟 **هنوز هیچ بازیکنی در رتبه‌بندی ثبت نشده است!** 🌟\n" \
-                          "🎮 بیا و در چالش یار شرکت کن تا نامت اینجا بدرخشه! ✨"
-            else:
-                message = "🌟 **جدول نفرات برتر چالش یار** 🌟\n\n"
-                for idx, (username, total_correct) in enumerate(leaderboard, 1):
-                    if idx == 1:
-                        medal = "🥇"
-                    elif idx == 2:
-                        medal = "🥈"
-                    elif idx == 3:
-                        medal = "🥉"
-                    else:
-                        medal = f"{idx}."
-                    message += f"{medal} **{username}** - {total_correct} پاسخ درست 🎉\n"
-                message += "\n🏆 به جمع برترین‌ها بپیوندید! 🚀"
-            await client.send_message(chat_id="@chalesh_yarr", text=message, disable_web_page_preview=True)
-            await asyncio.sleep(300)
-        except Exception as e:
-            logger.error(f"Error in announce_leaderboard: {str(e)}")
-            await asyncio.sleep(300)
+            await outbound.submit(PRIORITY_BROADCAST, "@chalesh_yarr", lambda: client.edit_message_text(
+                chat_id="@chalesh_yarr", message_id=message_id, text=message, disable_web_page_preview=True))
+        except MessageNotModified:
+            pass
+        except BadRequest as e:
+            logger.warning(f"Pinned leaderboard message {message_id} could not be edited: {str(e)}")
+            message_id = None
+    if not message_id:
+        sent = await outbound.submit(PRIORITY_BROADCAST, "@chalesh_yarr", lambda: client.send_message(
+            chat_id="@chalesh_yarr", text=message, disable_web_page_preview=True))
+        message_id = sent.id
+        # شناسه پیام پیش از سنجاق ذخیره می‌شود تا اگر سنجاق خطا داد اجرای بعدی پیام تازه نفرستد
+        announcement.update(message_id=message_id, hash=digest, window=window, pinned=False)
+        await db.write(save_bot_state, {"leaderboard_message_id": str(message_id), "leaderboard_hash": digest,
+                                        "leaderboard_window": window, "leaderboard_pinned": "0"})
+    if not announcement["pinned"]:
+        await outbound.submit(PRIORITY_BROADCAST, "@chalesh_yarr", lambda: client.pin_chat_message(
+            chat_id="@chalesh_yarr", message_id=message_id, disable_notification=True))
+    announcement.update(message_id=message_id, hash=digest, window=window, pinned=True)
+    await db.write(save_bot_state, {"leaderboard_message_id": str(message_id), "leaderboard_hash": digest,
+                                    "leaderboard_window": window, "leaderboard_pinned": "1"})
+    return True
+
+def next_leaderboard_window():
+    windows = list(LEADERBOARD_WINDOWS)
+    current = leaderboard_announcement["window"]
+    if current not in windows:
+        return windows[0]
+    return windows[(windows.index(current) + 1) % len(windows)]
+
+async def announce_leaderboard(client):
+    # پس از پایان بازی‌ها زمان‌بند این کار را زودتر بیدار می‌کند؛ هر اجرا بازه بعدی را در همان پیام نشان می‌دهد،
+    # ولی اگر از آخرین انتشار امتیازی ثبت نشده باشد نه چرخشی هست و نه درخواستی
+    version = leaderboard_cache.current_version()
+    if version == leaderboard_announcement["version"] and leaderboard_announcement["message_id"]:
+        return
+    window = next_leaderboard_window()
+    # خطاها به PeriodicJob می‌رسند تا عقب‌نشینی و FloodWait آنجا اعمال شود
+    if not await publish_leaderboard(client, window):
+        # متن بازه بعدی با پیام فعلی یکی است؛ نوبت جلو می‌رود ولی درخواستی فرستاده نمی‌شود
+        leaderboard_announcement["window"] = window
+    leaderboard_announcement["version"] = version
+
+async def rollup_leaderboard_job():
+    cutoff_date = (datetime.now() - timedelta(days=LEADERBOARD_RETENTION_DAYS)).strftime("%Y-%m-%d")
+    season_id, days = await db.write(rollup_leaderboard, cutoff_date)
+    if days:
+        logger.info(f"Rolled up {days} days of leaderboard rows into season {season_id}")
+    # اگر فصل با clearLeaderName.py بسته شده باشد جدول حافظه از نو بارگذاری می‌شود
+    if season_id is not None and season_id != current_season["id"]:
+        logger.info(f"Season changed from {current_season['id']} to {season_id}, reloading leaderboard")
+        current_season["id"] = season_id
+        keys = leaderboard_window_keys()
+        leaderboard_cache.seed(await db.read(load_leaderboard_windows, season_id, *keys), keys)
+        leaderboard_changed.set()
 
 async def cleanup_expired_games():
-    while True:
-        try:
-            expired_games = [game_id for game_id, game in games.items() if game.is_expired()]
-            for game_id in expired_games:
-                del games[game_id]
-                logger.info(f"Cleaned up expired game: {game_id}")
-            await asyncio.sleep(300)
-        except Exception as e:
-            logger.error(f"Error in cleanup_expired_games: {str(e)}")
-            await asyncio.sleep(300)
+    expired_games = [game_id for game_id, game in games.items() if game.is_expired() and game_id not in game_tasks]
+    for game_id in expired_games:
+        del games[game_id]
+        logger.info(f"Cleaned up expired game: {game_id}")
 
 def test_db_connection():
-    db_path = "plugins/questions.db"
-    if not os.path.exists(db_path):
-        logger.error(f"Database file {db_path} does not exist")
+    if not os.path.exists(db.db_path):
+        logger.error(f"Database file {db.db_path} does not exist")
         return False
     try:
-        with sqlite3.connect(db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            return True
+        db.call(lambda conn: conn.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall())
+        return True
     except Exception as e:
         logger.error(f"Error testing DB connection: {str(e)}")
         return False
@@ -385,36 +1306,62 @@ def get_combined_questions(game, topics, total_questions):
     try:
         if not topics:
             raise ValueError("هیچ موضوعی انتخاب نشده است!")
-        num_topics = len(topics)
-        questions_per_topic = max(1, total_questions // num_topics)
-        remaining_questions = total_questions - (questions_per_topic * num_topics)
-        all_questions = []
-        for topic in topics:
-            table_name = TOPIC_TO_TABLE.get(topic)
-            if not table_name:
-                continue
-            num_questions = questions_per_topic + (1 if remaining_questions > 0 else 0)
-            if remaining_questions > 0:
-                remaining_questions -= 1
-            questions = game.get_random_questions(table_name, min(num_questions, total_questions - len(all_questions)))
-            all_questions.extend(questions)
-        random.shuffle(all_questions)
-        return all_questions[:total_questions]
+        questions = question_bank.sample(topics, total_questions, game.used_questions)
+        if len(questions) < total_questions:
+            logger.warning(f"Only {len(questions)} of {total_questions} questions available for topics {topics}")
+        return questions
     except Exception as e:
         logger.error(f"Error getting combined questions: {str(e)}")
         return []
 
-def create_options_keyboard(game_id, option1, option2):
+def create_options_keyboard(game_id, option1, option2, number):
+    # شماره سوال در دکمه است تا پاسخی که پیش از رسیدن سوال بعدی زده شده با همان سوال سنجیده شود
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"🔵 {option1}", callback_data=f"{game_id}|option_1")],
-        [InlineKeyboardButton(f"🟢 {option2}", callback_data=f"{game_id}|option_2")]
+        [InlineKeyboardButton(f"🔵 {option1}", callback_data=f"{game_id}|option_1|{number}")],
+        [InlineKeyboardButton(f"🟢 {option2}", callback_data=f"{game_id}|option_2|{number}")]
     ])
 
+def render_question_screens(game, seconds):
+    # متن و کیبورد همه سوالات یک بار در شروع بازی ساخته می‌شود
+    settings = game.get_settings_summary()
+    total_questions = len(game.questions)
+    return [
+        (
+            f"❓ سوال {number} از {total_questions}\n⏳ {seconds} ثانیه وقت دارید:\n\n{question_text}\n\n{settings}",
+            create_options_keyboard(game.game_id, option1, option2, number)
+        )
+        for number, (question_text, option1, option2, _) in enumerate(game.questions, 1)
+    ]
+
 if not test_db_connection():
     logger.critical("Failed to connect to database. Exiting.")
     exit(1)
 
-init_leaderboard_db()
+db.call(init_leaderboard_db)
+
+current_season["id"] = db.call(get_open_season)
+db.call(seed_leaderboard_cache)
+
+# اعضای ذخیره‌شده از اجرای قبلی تا رسیدن پیمایش بعدی معتبر فرض می‌شوند
+loaded_at = time.monotonic()
+channel_members_cache = {
+    user_id: {"status": status, "last_updated": last_updated, "checked_at": loaded_at}
+    for user_id, last_updated, status in db.call(load_channel_members) if status in MEMBER_STATUSES
+}
+logger.info(f"Channel members loaded: {len(channel_members_cache)} members")
+bot_state = db.call(load_bot_state)
+if bot_state.get("leaderboard_message_id"):
+    leaderboard_announcement.update(message_id=int(bot_state["leaderboard_message_id"]),
+                                    hash=bot_state.get("leaderboard_hash"),
+                                    window=bot_state.get("leaderboard_window"),
+                                    pinned=bot_state.get("leaderboard_pinned", "1") == "1")
+logger.info(f"Leaderboard loaded: {len(leaderboard_cache)} players")
+
+try:
+    logger.info(f"Question bank loaded: {db.call(question_bank.load)} questions")
+except Exception as e:
+    logger.critical(f"Failed to load question bank: {str(e)}")
+    exit(1)
 
 @Client.on_inline_query()
 async def inline_main_menu(client: Client, inline_query):
@@ -427,7 +1374,7 @@ async def inline_main_menu(client: Client, inline_query):
         settings = game.get_settings_summary()
         footer = "📢 برای شرکت در بازی باید عضو کانال چالش-یار (@chalesh_yarr) باشید.    "
         message = f"{header}\n{settings}\n\n{footer}"
-        await inline_query.answer(
+        await outbound.submit(PRIORITY_CALLBACK, None, lambda: inline_query.answer(
             results=[
                 InlineQueryResultArticle(
                     title="🎮 تنظیمات بازی",
@@ -437,25 +1384,28 @@ async def inline_main_menu(client: Client, inline_query):
                 )
             ],
             cache_time=1
-        )
+        ))
     except Exception as e:
         logger.error(f"Error in inline_main_menu: {str(e)}")
-        await inline_query.answer(
+        await outbound.submit(PRIORITY_CALLBACK, None, lambda: inline_query.answer(
             results=[],
             cache_time=1,
             switch_pm_text="⚠️ خطا در پردازش درخواست!",
             switch_pm_parameter="error"
-        )
+        ))
+
+EXPIRED_GAME_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ بازی منقضی شده", callback_data="expired")]])
 
 def my_start_def_glassButton(game_id):
     game = games.get(game_id)
     if not game:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("❌ بازی منقضی شده", callback_data="expired")]])
+        return EXPIRED_GAME_KEYBOARD
     selections = game.selections
-    number = selections["number"]
-    times = selections["time"]
-    topics = selections["topics"]
+    return render_settings_keyboard(game_id, selections["number"], tuple(selections["time"]), frozenset(selections["topics"]))
 
+@lru_cache(maxsize=4096)
+def render_settings_keyboard(game_id, number, times, topics):
+    # هر ترکیب انتخاب‌ها برای هر بازی فقط یک بار ساخته می‌شود
     def cb(data): return f"{game_id}|{data}"
 
     return InlineKeyboardMarkup([
@@ -483,32 +1433,32 @@ def my_start_def_glassButton(game_id):
 
 @Client.on_callback_query()
 async def handle_callback_query(client: Client, callback_query: CallbackQuery):
-    if callback_query.id in processed_queries:
+    if processed_queries.seen(callback_query.id):
         return
-    processed_queries.add(callback_query.id)
     from_user = callback_query.from_user
     from_user_id = from_user.id
     data = callback_query.data
     logger.info(f"Callback query from user {from_user_id}: {data}")
     if data == "expired":
         try:
-            await callback_query.answer("❌ این بازی منقضی شده است.", show_alert=True)
+            await answer_callback(callback_query, "❌ این بازی منقضی شده است.", show_alert=True)
         except QueryIdInvalid:
             pass
         return
     try:
         game_id, pure_data = data.split("|", 1)
+        pure_data, _, question_number = pure_data.partition("|")
         game = games.get(game_id)
         if not game:
             try:
-                await callback_query.answer("❌ بازی نامعتبر یا منقضی شده است", show_alert=True)
+                await answer_callback(callback_query, "❌ بازی نامعتبر یا منقضی شده است", show_alert=True)
             except QueryIdInvalid:
                 pass
             return
         owner_id = game.owner_id
     except ValueError:
         try:
-            await callback_query.answer("❌ دکمه نامعتبر", show_alert=True)
+            await answer_callback(callback_query, "❌ دکمه نامعتبر", show_alert=True)
         except QueryIdInvalid:
             pass
         return
@@ -517,7 +1467,7 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
     needs_update = False
     if from_user_id != owner_id and pure_data not in ["ready_now", "option_1", "option_2"]:
         try:
-            await callback_query.answer("⛔ فقط سازنده بازی می‌تواند تنظیمات را تغییر دهد", show_alert=True)
+            await answer_callback(callback_query, "⛔ فقط سازنده بازی می‌تواند تنظیمات را تغییر دهد", show_alert=True)
         except QueryIdInvalid:
             pass
         return
@@ -554,9 +1504,10 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             })
         elif pure_data == "start_exam":
             if not selections["number"] or not selections["time"] or not selections["topics"]:
-                await callback_query.answer("لطفاً همه فیلدها را انتخاب کنید ❗", show_alert=True)
+                await answer_callback(callback_query, "لطفاً همه فیلدها را انتخاب کنید ❗", show_alert=True)
                 return
-            await callback_query.edit_message_text(
+            cancel_lobby_edit(callback_query)
+            await edit_callback_message(callback_query, PRIORITY_LOBBY,
                 f"🎯 لطفاً یکی از گزینه‌ها را انتخاب کنید:                                              \n\n{game.get_settings_summary()}\n\n{await get_players_list(client, game_id)}\n\n📢 برای شرکت در بازی باید عضو کانال چالش-یار (@chalesh_yarr) باشید.    ",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("✅ حاضر", callback_data=f"{game_id}|ready_now")],
@@ -573,23 +1524,15 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             })
             return
         elif pure_data == "ready_now":
-            status_from_cache = check_member_in_cache(from_user_id)
-            if status_from_cache and status_from_cache in ["member", "administrator", "owner", "restricted"]:
+            member_status = await get_member_status(client, from_user_id)
+            if member_status in MEMBER_STATUSES:
                 if from_user_id in game.players:
-                    await callback_query.answer("✅ شما قبلاً به بازی پیوسته‌اید", show_alert=True)
+                    await answer_callback(callback_query, "✅ شما قبلاً به بازی پیوسته‌اید", show_alert=True)
                     return
                 game.players.append(from_user_id)
                 if from_user_id not in user_cache:
                     user_cache[from_user_id] = from_user
-                await callback_query.edit_message_text(
-                    f"🎯 لطفاً یکی از گزینه‌ها را انتخاب کنید:                                              \n\n{game.get_settings_summary()}\n\n{await get_players_list(client, game_id)}\n\n📢 برای شرکت در بازی باید عضو کانال چالش-یار (@chalesh_yarr) باشید.    ",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ حاضر", callback_data=f"{game_id}|ready_now")],
-                        [InlineKeyboardButton("🚀 شروع", callback_data=f"{game_id}|start_now")],
-                        [InlineKeyboardButton("🔙 برگشت به منو", callback_data=f"{game_id}|back_to_menu")],
-                        [InlineKeyboardButton("🗑️ لغو بازی", callback_data=f"{game_id}|cancel_game")]
-                    ])
-                )
+                schedule_lobby_edit(client, callback_query, game_id)
                 await answer_queue.put({
                     'callback_query_id': callback_query.id,
                     'type': 'response',
@@ -597,28 +1540,33 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
                     'show_alert': False
                 })
                 return
-            await callback_query.answer("⛔ شما حاضر نیستید! لطفاً ابتدا عضو کانال چالش-یار شوید! 👉 @chalesh_yarr",
+            await answer_callback(callback_query, "⛔ شما حاضر نیستید! لطفاً ابتدا عضو کانال چالش-یار شوید! 👉 @chalesh_yarr",
                                         show_alert=True)
             return
         elif pure_data in ["option_1", "option_2"]:
             if from_user_id not in game.players:
-                await callback_query.answer("⛔ شما در این بازی حضور ندارید!", show_alert=True)
+                await answer_callback(callback_query, "⛔ شما در این بازی حضور ندارید!", show_alert=True)
                 return
             await answer_queue.put({
                 'callback_query_id': callback_query.id,
                 'type': 'answer',
                 'game_id': game_id,
                 'user_id': from_user_id,
-                'pure_data': pure_data,
+                'option': OPTION_TO_INDEX[pure_data],
+                'question': int(question_number) if question_number.isdigit() else None,
                 'text': ""
             })
             return
         elif pure_data == "start_now":
             if from_user_id != owner_id:
-                await callback_query.answer("⛔ فقط سازنده می‌تواند بازی را شروع کند", show_alert=True)
+                await answer_callback(callback_query, "⛔ فقط سازنده می‌تواند بازی را شروع کند", show_alert=True)
+                return
+            if game_id in game_tasks:
+                await answer_callback(callback_query, "⏳ بازی در حال اجراست", show_alert=False)
                 return
             if len(game.players) < 2:
-                await callback_query.edit_message_text(
+                cancel_lobby_edit(callback_query)
+                await edit_callback_message(callback_query, PRIORITY_LOBBY,
                     f"⏳ در انتظار ورود بازیکن (حداقل 2 بازیکن مورد نیاز است):                                              \n\n{game.get_settings_summary()}\n\n{await get_players_list(client, game_id)}\n\n📢 برای شرکت در بازی باید عضو کانال چالش-یار (@chalesh_yarr) باشید.    ",
                     reply_markup=InlineKeyboardMarkup([
                         [InlineKeyboardButton("✅ حاضر", callback_data=f"{game_id}|ready_now")],
@@ -627,74 +1575,24 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
                         [InlineKeyboardButton("🗑️ لغو بازی", callback_data=f"{game_id}|cancel_game")]
                     ])
                 )
-                await callback_query.answer("⛔ حداقل 2 بازیکن برای شروع لازم است", show_alert=True)
+                await answer_callback(callback_query, "⛔ حداقل 2 بازیکن برای شروع لازم است", show_alert=True)
                 return
             time_str = selections["time"][0]
             seconds = int(time_str.replace("time", ""))
-            total_questions = game.get_total_questions()
-            game.questions = get_combined_questions(game, selections["topics"], total_questions)
+            game.questions = get_combined_questions(game, selections["topics"], game.get_total_questions())
             if not game.questions:
-                await callback_query.answer("⚠️ خطا در بارگذاری سوالات! لطفاً موضوعات دیگر را انتخاب کنید.",
+                await answer_callback(callback_query, "⚠️ خطا در بارگذاری سوالات! لطفاً موضوعات دیگر را انتخاب کنید.",
                                             show_alert=True)
                 return
+            game.question_screens = render_question_screens(game, seconds)
             for player_id in game.players:
                 game.scores[player_id] = 0
-            for question_idx in range(total_questions):
-                game.current_question = question_idx + 1
-                game.choices[game.current_question] = {}
-                question_text, option1, option2, _ = game.questions[question_idx]
-                try:
-                    keyboard = create_options_keyboard(game_id, option1, option2)
-                    await callback_query.edit_message_text(
-                        f"❓ سوال {game.current_question} از {total_questions}\n⏳ {seconds} ثانیه وقت دارید:\n\n{question_text}\n\n{game.get_settings_summary()}",
-                        reply_markup=keyboard
-                    )
-                except MessageNotModified:
-                    pass
-                except Exception as e:
-                    logger.error(f"Error displaying question: {str(e)}")
-                    break
-                await asyncio.sleep(seconds)
-            result_lines = ["📊 نتایج بازی:"]
-            sorted_players = sorted(game.players, key=lambda pid: game.scores.get(pid, 0), reverse=True)
-            for rank, player_id in enumerate(sorted_players, 1):
-                player_name = user_cache.get(player_id, await client.get_users(player_id)).first_name
-                result_lines.append(f"{rank}. {player_name}")
-                status_row = []
-                for question_idx in range(total_questions):
-                    question_num = question_idx + 1
-                    choice = game.choices.get(question_num, {}).get(player_id, None)
-                    if choice:
-                        _, _, _, correct_answer = game.questions[question_idx]
-                        is_correct = choice[-1] == correct_answer[-1]
-                        status_row.append("✅" if is_correct else "❌")
-                    else:
-                        status_row.append("☐")
-                status_line = " ".join(status_row)
-                result_lines.append(status_line)
-                correct_count = status_row.count("✅")
-                wrong_count = status_row.count("❌")
-                unanswered_count = status_row.count("☐")
-                result_lines.append(f"✅ {correct_count} | ❌ {wrong_count} | ☐ {unanswered_count}")
-                save_player_score(player_id, player_name, correct_count)
-            try:
-                if callback_query.message:
-                    await client.send_message(chat_id=callback_query.message.chat.id, text="\n".join(result_lines),
-                                              disable_web_page_preview=True)
-                elif callback_query.inline_message_id:
-                    await callback_query.edit_message_text(text="\n".join(result_lines), disable_web_page_preview=True)
-                del games[game_id]
-            except MessageNotModified:
-                pass
-            except Exception as e:
-                logger.error(f"Error displaying results: {str(e)}")
-                try:
-                    await callback_query.answer("⚠️ خطایی در نمایش نتایج رخ داد", show_alert=True)
-                except QueryIdInvalid:
-                    pass
+            cancel_lobby_edit(callback_query)
+            start_game(client, callback_query, game, seconds)
             return
         elif pure_data == "back_to_menu":
-            await callback_query.edit_message_text(
+            cancel_lobby_edit(callback_query)
+            await edit_callback_message(callback_query, PRIORITY_LOBBY,
                 f"🎮 لطفاً تعداد سوال، زمان و موضوع را انتخاب کنید:                                              \n\n{game.get_settings_summary()}",
                 reply_markup=my_start_def_glassButton(game_id)
             )
@@ -706,8 +1604,12 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             })
             return
         elif pure_data == "cancel_game":
-            await callback_query.edit_message_text("🗑️ بازی لغو شد.")
-            del games[game_id]
+            task = game_tasks.pop(game_id, None)
+            if task:
+                task.cancel()
+            cancel_lobby_edit(callback_query)
+            await edit_callback_message(callback_query, PRIORITY_LOBBY, "🗑️ بازی لغو شد.")
+            games.pop(game_id, None)
             await answer_queue.put({
                 'callback_query_id': callback_query.id,
                 'type': 'response',
@@ -717,7 +1619,8 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             return
         if needs_update:
             try:
-                await callback_query.edit_message_text(
+                cancel_lobby_edit(callback_query)
+                await edit_callback_message(callback_query, PRIORITY_LOBBY,
                     f"🎮 لطفاً تعداد سوال، زمان و موضوع را انتخاب کنید:                                              \n\n{game.get_settings_summary()}",
                     reply_markup=my_start_def_glassButton(game_id)
                 )
@@ -735,10 +1638,134 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
     except Exception as e:
         logger.error(f"Error in handle_callback_query: {str(e)}")
         try:
-            await callback_query.answer("⚠️ خطایی رخ داد!", show_alert=True)
+            await answer_callback(callback_query, "⚠️ خطایی رخ داد!", show_alert=True)
         except QueryIdInvalid:
             pass
 
+def start_game(client, callback_query, game, seconds):
+    # هر بازی در تسک جداگانه خودش اجرا می‌شود تا هندلر فوراً برگردد
+    task = asyncio.create_task(run_game(client, callback_query, game, seconds))
+    game_tasks[game.game_id] = task
+    task.add_done_callback(lambda _: game_tasks.pop(game.game_id, None))
+    return task
+
+async def run_game(client, callback_query, game, seconds):
+    game_id = game.game_id
+    total_questions = len(game.questions)
+    try:
+        # زمان هر سوال از لحظه شروع بازی حساب می‌شود تا تأخیر ارسال‌ها روی هم جمع نشود
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for question_idx in range(total_questions):
+            game.current_question = question_idx + 1
+            game.choices[game.current_question] = {}
+            text, keyboard = game.question_screens[question_idx]
+            try:
+                await edit_callback_message(callback_query, PRIORITY_GAME, text, reply_markup=keyboard)
+            except MessageNotModified:
+                pass
+            except Exception as e:
+                logger.error(f"Error displaying question: {str(e)}")
+                break
+            await asyncio.sleep(max(0.0, started + (question_idx + 1) * seconds - loop.time()))
+        result_lines = ["📊 نتایج بازی:"]
+        sorted_players = sorted(game.players, key=lambda pid: game.scores.get(pid, 0), reverse=True)
+        game_scores = []
+        for rank, player_id in enumerate(sorted_players, 1):
+            player_name = user_cache.get(player_id, await client.get_users(player_id)).first_name
+            result_lines.append(f"{rank}. {player_name}")
+            status_row = []
+            for question_idx in range(total_questions):
+                question_num = question_idx + 1
+                choice = game.choices.get(question_num, {}).get(player_id, None)
+                if choice:
+                    is_correct = choice == game.questions[question_idx][3]
+                    status_row.append("✅" if is_correct else "❌")
+                else:
+                    status_row.append("☐")
+            status_line = " ".join(status_row)
+            result_lines.append(status_line)
+            correct_count = status_row.count("✅")
+            wrong_count = status_row.count("❌")
+            unanswered_count = status_row.count("☐")
+            result_lines.append(f"✅ {correct_count} | ❌ {wrong_count} | ☐ {unanswered_count}")
+            game_scores.append((player_id, player_name, correct_count))
+        if await db.write(save_game_scores, game_scores):
+            for player_id, player_name, correct_count in game_scores:
+                leaderboard_cache.add(player_id, player_name, correct_count)
+            leaderboard_changed.set()
+        try:
+            if callback_query.message:
+                await outbound.submit(PRIORITY_GAME, callback_query.message.chat.id, lambda: client.send_message(
+                    chat_id=callback_query.message.chat.id, text="\n".join(result_lines),
+                    disable_web_page_preview=True))
+            elif callback_query.inline_message_id:
+                await edit_callback_message(callback_query, PRIORITY_GAME, text="\n".join(result_lines),
+                                            disable_web_page_preview=True)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.error(f"Error displaying results: {str(e)}")
+            try:
+                await answer_callback(callback_query, "⚠️ خطایی در نمایش نتایج رخ داد", show_alert=True)
+            except QueryIdInvalid:
+                pass
+    except asyncio.CancelledError:
+        logger.info(f"Game {game_id} cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"Error running game {game_id}: {str(e)}")
+    finally:
+        games.pop(game_id, None)
+
+def schedule_lobby_edit(client, callback_query, game_id):
+    # ویرایش‌های پشت سر هم یک پیام لابی یکی می‌شوند و فقط آخرین وضعیت پس از LOBBY_EDIT_DELAY ارسال می‌شود
+    key = callback_message_key(callback_query)
+    pending = lobby_edits.get(key)
+    if pending:
+        pending["callback_query"] = callback_query
+        return
+    lobby_edits[key] = {"callback_query": callback_query, "game_id": game_id}
+    lobby_edits[key]["task"] = asyncio.create_task(flush_lobby_edit(client, key))
+
+def cancel_lobby_edit(callback_query):
+    # ویرایش مستقیم همین پیام، ویرایش معوق لابی را بی‌اثر می‌کند تا صفحه تازه باز شده دوباره لابی نشود
+    pending = lobby_edits.pop(callback_message_key(callback_query), None)
+    if pending:
+        pending["task"].cancel()
+
+async def flush_lobby_edit(client, key):
+    await asyncio.sleep(LOBBY_EDIT_DELAY)
+    pending = lobby_edits[key]
+    game_id = pending["game_id"]
+    game = games.get(game_id)
+    if not game or game.current_question:
+        lobby_edits.pop(key, None)
+        return
+    try:
+        players_list = await get_players_list(client, game_id)
+        # تا لحظه ارسال در lobby_edits می‌ماند تا ویرایش مستقیم همین پیام بتواند آن را لغو کند
+        if lobby_edits.get(key) is not pending:
+            return
+        del lobby_edits[key]
+        await edit_callback_message(
+            pending["callback_query"], PRIORITY_LOBBY,
+            f"🎯 لطفاً یکی از گزینه‌ها را انتخاب کنید:                                              \n\n{game.get_settings_summary()}\n\n{players_list}\n\n📢 برای شرکت در بازی باید عضو کانال چالش-یار (@chalesh_yarr) باشید.    ",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ حاضر", callback_data=f"{game_id}|ready_now")],
+                [InlineKeyboardButton("🚀 شروع", callback_data=f"{game_id}|start_now")],
+                [InlineKeyboardButton("🔙 برگشت به منو", callback_data=f"{game_id}|back_to_menu")],
+                [InlineKeyboardButton("🗑️ لغو بازی", callback_data=f"{game_id}|cancel_game")]
+            ])
+        )
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.error(f"Error updating lobby message: {str(e)}")
+    finally:
+        if lobby_edits.get(key) is pending:
+            del lobby_edits[key]
+
 async def get_players_list(client, game_id):
     game = games.get(game_id, Game(0))
     if not game.players: